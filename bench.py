@@ -0,0 +1,118 @@
+"""
+Foos Benchmarks
+
+Run with ``python bench.py [name ...]``. With no names, every benchmark runs.
+
+"""
+import os
+import sys
+import time
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """ Registers a benchmark under its function name. """
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def median(values):
+    """ Median of a non-empty sequence. """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def report(name, seconds):
+    """ Prints a single timing line. """
+    sys.stdout.write("%-32s %10.2f ms\n" % (name, seconds * 1000))
+
+
+def spawn(code, runs):
+    """ Times `runs` fresh interpreters executing `code`. """
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code], cwd=HERE)
+        timings.append(time.time() - start)
+    return median(timings)
+
+
+@benchmark
+def startup(runs=20):
+    """ Cold import and app construction. Needs no running MongoDB. """
+    interpreter = spawn('pass', runs)
+    cold_import = spawn('import foos', runs)
+    cold_app = spawn('import foos; foos.make_app()', runs)
+
+    report('interpreter', interpreter)
+    report('import foos', cold_import - interpreter)
+    report('import foos + make_app()', cold_app - interpreter)
+
+    sys.path.insert(0, HERE)
+    import foos
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        foos.make_app()
+        timings.append(time.time() - start)
+    report('make_app() (warm)', median(timings))
+
+
+@benchmark
+def matchmaking(runs=1000):
+    """ Opponent lookups against growing in-memory player indexes. """
+    import random
+    from datetime import datetime, timedelta
+
+    sys.path.insert(0, HERE)
+    import bson
+    import foos
+
+    now = datetime.now()
+    for size in (100, 1000, 10000, 100000):
+        players = []
+        for _ in range(size):
+            games = random.randint(0, 200)
+            wins = random.randint(0, games)
+            players.append(foos.Player(
+                    _id=bson.ObjectId(),
+                    games=games,
+                    wins=wins,
+                    losses=games - wins,
+                    points_for=random.randint(wins * 5, games * 5),
+                    points_against=random.randint((games - wins) * 5,
+                        games * 5),
+                    last_played=now - timedelta(minutes=random.randint(0,
+                        10000)),
+                    ))
+        matchmaker = foos.Matchmaker()
+        start = time.time()
+        matchmaker.load(players)
+        report('load %d players' % size, time.time() - start)
+
+        skills = [random.random() for _ in range(runs)]
+        start = time.time()
+        for skill in skills:
+            matchmaker.nearest(skill)
+        report('nearest() with %d players' % size,
+                (time.time() - start) / runs)
+
+
+def main(names):
+    """ Runs the named benchmarks, or all of them. """
+    for name in names or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            sys.exit("Unknown benchmark: %s" % name)
+        sys.stdout.write("%s\n" % name)
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,28 +2,49 @@
 The Foosball App
 
 """
+import sys
 import json
+import time
+import bisect
 import functools
+import threading
 from datetime import datetime
 
 import bson
 import bottle
-import static
-from minimongo import Model
+from minimongo import Model, Index
+from pymongo.errors import DuplicateKeyError
 from bottle import request, response, template, redirect
 
-# Direct call to bottle's helper function to avoid false import errors
-get = bottle.make_default_app_wrapper('get')
-post = bottle.make_default_app_wrapper('post')
-
 ############
 # Settings #
 ############
 
 DATABASE = 'foos'
+DATABASE_HOST = 'localhost'
+DATABASE_PORT = 27017
 STATIC_MOUNT = '/static/'
 API_MOUNT = '/api/v1/json'
 
+MATCH_REFRESH = 60  # Seconds between rebuilds of the matchmaking index
+MATCH_FRESHNESS = 5  # Recent games whose opponents make a stale pairing
+MATCH_SCAN = 25  # Nearest players examined per suggestion
+MATCH_RETRIES = 3  # Attempts at pairing a player who joins the queue
+MATCH_TOLERANCE = 0.1  # Skill gap a newly waiting player will accept
+MATCH_WIDEN = 0.02  # Extra skill gap accepted per minute spent waiting
+
+INGEST_BATCH = 50  # Most score events accepted in one batch
+INGEST_RATE = 5  # Score events per second allowed per device
+INGEST_BURST = INGEST_BATCH  # Score events a device may send at once
+INGEST_DEVICES = 10000  # Most devices rate limited at once
+INGEST_MAX_AGE = 24 * 60 * 60  # Seconds before an event time is implausible
+INGEST_DEBOUNCE = 1.0  # Seconds within which a scorer's repeat goal is bounce
+INGEST_RETRIES = 5  # Attempts at a game write before giving up
+
+TOURNAMENT_RETRIES = 5  # Attempts at a tournament write before giving up
+
+AUDIT_CHUNK = 100  # Players audited per task handed to a worker process
+
 ##############
 # Exceptions #
 ##############
@@ -40,13 +61,17 @@ class BaseModelException(FoosException):
 
 class ModelMixin(object):
     """ Common methods for minimongo :class:`Model` subclasses. """
+    #: :class:`minimongo.Index` instances ensured by :func:`connect`.
+    indices = ()
+
     def store(self, key, value):
         """ Assigns directly to __dict__. """
         self.__dict__[key] = value
 
     @classmethod
     def mongo(cls):
-        """ Wrapper around Model.collection. """
+        """ Wrapper around Model.collection. Connects on first use. """
+        connect()
         return getattr(cls, 'collection')
 
     @classmethod
@@ -76,6 +101,11 @@ class ModelMixin(object):
             return cursor(cls.mongo().find({'_id': {'$in': ids}}))
         return cursor(cls.mongo().find())
 
+    def save(self, *args, **kwargs):
+        """ Wrapper around save. Connects on first use. """
+        connect()
+        return super(ModelMixin, self).save(*args, **kwargs)
+
     def delete(self):
         """ Wrapper around remove. """
         self.mongo().remove({'_id': self._id})
@@ -88,8 +118,8 @@ class ModelMixin(object):
 class Player(ModelMixin, Model):
     """ Player model. """
     class Meta(object):
-        """ Minimongo settings. """
-        database = DATABASE
+        """ Minimongo settings. The collection is bound by :func:`connect`. """
+        interface = True
 
     def __init__(self, *args, **kwargs):
         self.name = 'Anonymous'
@@ -169,6 +199,70 @@ class Player(ModelMixin, Model):
                 sort=[('start', -1)])
                         .limit(count))
 
+    def recent_opponents(self, count=MATCH_FRESHNESS):
+        """ Returns a `set` of player ids faced in recent games.
+
+            :param int count: Number of recent games considered.
+
+        """
+        _id = str(self._id)
+        opponents = set()
+        for game in self.recent_games(count):
+            opponents.update(game.players)
+        opponents.discard(_id)
+        return opponents
+
+    def tally(self):
+        """ Recomputes this player's counters from their finished games,
+            streamed through the games' player index.
+
+            :returns: `dict` of counter values, keyed like the attributes.
+
+        """
+        _id = str(self._id)
+        tally = dict(games=0, wins=0, losses=0, incomplete=0, points_for=0,
+                points_against=0, playtime=0, last_played=None)
+        games = Game.mongo().find(
+                {'players': _id, 'start': {'$ne': None}, 'end': {'$ne': None}},
+                fields=('players', 'scores', 'winner', 'incomplete', 'start',
+                    'end'))
+        for game in games:
+            tally['playtime'] += (game.end - game.start).total_seconds()
+            if game.incomplete:
+                tally['incomplete'] += 1
+                continue
+            if game.players[0] == _id:
+                opponent = game.players[1]
+            else:
+                opponent = game.players[0]
+            tally['games'] += 1
+            tally['wins' if game.winner == _id else 'losses'] += 1
+            tally['points_for'] += game.scores[_id]
+            tally['points_against'] += game.scores[opponent]
+            if tally['last_played'] is None or \
+                    game.end > tally['last_played']:
+                tally['last_played'] = game.end
+        return tally
+
+    def drift(self):
+        """ Compares the stored counters with :meth:`Player.tally`.
+
+            :returns: `dict` of ``(stored, actual)`` pairs for each counter
+                that's wrong.
+
+        """
+        drift = {}
+        for key, actual in self.tally().items():
+            stored = self.get(key)
+            if key == 'playtime':
+                # Float sums depend on the order games were added in
+                wrong = stored is None or abs(stored - actual) >= 1
+            else:
+                wrong = stored != actual
+            if wrong:
+                drift[key] = (stored, actual)
+        return drift
+
     def rename(self, name):
         """ Renames the current player. Calls :exc:`Player.valid_name` to
             check the name.
@@ -187,6 +281,18 @@ class Player(ModelMixin, Model):
             return 0.0
         return round(1.0 * self.wins / self.games, 3)
 
+    @property
+    def skill(self):
+        """ Skill estimate between 0 and 1, blending the win rate with the
+            share of points scored. Both are smoothed so new players start
+            in the middle.
+
+        """
+        win_rate = (self.wins + 1.0) / (self.games + 2)
+        points = self.points_for + self.points_against
+        point_share = (self.points_for + 1.0) / (points + 2)
+        return round((win_rate + point_share) / 2, 4)
+
     @property
     def url(self):
         """ Url for the player. """
@@ -209,8 +315,12 @@ class Player(ModelMixin, Model):
 class Game(ModelMixin, Model):
     """ Game model. """
     class Meta(object):
-        """ Minimongo settings. """
-        database = DATABASE
+        """ Minimongo settings. The collection is bound by :func:`connect`. """
+        interface = True
+
+    indices = (
+            Index([('players', 1), ('start', -1)]),
+            )
 
     def __init__(self, *args, **kwargs):
         self.start = datetime.now()
@@ -221,6 +331,10 @@ class Game(ModelMixin, Model):
         self.loser = None
         self.timeline = []
         self.incomplete = False
+        self.tournament = None
+        self.slot = None
+        self.sequences = {}
+        self.device_goals = {}
         super(Game, self).__init__(*args, **kwargs)
 
     @classmethod
@@ -253,12 +367,25 @@ class Game(ModelMixin, Model):
                 scores=dict(zip(players, (0, 0)))
                 ).save()
 
+    @classmethod
+    def schedule(cls, games):
+        """ Inserts a batch of games in one database operation. Scheduled
+            games have no `start` until their first score.
+
+            :param list games: Unsaved :class:`Game` instances.
+            :returns: `games`
+
+        """
+        if games:
+            cls.mongo().insert(games)
+        return games
+
     @classmethod
     def play(cls, game, scorer):
         """ Records a score. """
         if not scorer:
             raise cls.Error("Who scored?")
-        game = game.fetch(game)
+        game = cls.fetch(game)
         if game.end:
             raise cls.GameOver("That game's already over.")
         if scorer == 'nobody':
@@ -266,44 +393,147 @@ class Game(ModelMixin, Model):
         if scorer not in game.players:
             raise cls.Error("Who did you say scored?")
 
+        if not game.start:
+            # First score of a scheduled game
+            game.start = datetime.now()
         game.timeline.append([scorer, datetime.now()])
         game.scores[scorer] += 1
 
-        if game.scores[scorer] < 5:
-            # Play continues
-            return game.save()
+        if game.scores[scorer] >= 5:
+            # We have a winner
+            game._decide(scorer)
 
-        # We have a winner
-        game.end = datetime.now()
-        playtime = (game.end - game.start).total_seconds()
+        # Only one write can end a game, so its players are credited once
+        if not cls.mongo().find_and_modify({'_id': game._id, 'end': None},
+                update=game):
+            raise cls.GameOver("That game's already over.")
+        if game.end:
+            game._credit()
+
+        return game
+
+    @classmethod
+    def ingest(cls, game, device, events):
+        """ Applies a batch of score events from one device to a game, in a
+            single conditional write.
+
+            Events at or below the device's last applied sequence number are
+            retries and are skipped, as are goals within
+            :data:`INGEST_DEBOUNCE`, by the device's clock, of the same
+            scorer's previous event. Event times are kept between the
+            previous goal and now. Events after the winning goal are
+            acknowledged but not scored.
+
+            :param game: Game._id the events belong to.
+            :param str device: Id of the sending device.
+            :param list events: ``(seq, scorer, datetime)`` tuples.
+            :returns: The updated game.
+
+        """
+        events = sorted(events)
+        for _ in range(INGEST_RETRIES):
+            current = cls.fetch(game)
+            last = current.sequences.get(device)
+            query = {
+                    '_id': current._id,
+                    'end': current.end,
+                    'sequences.%s' % device:
+                        {'$exists': False} if last is None else last,
+                    }
+            for _id, score in current.scores.items():
+                query['scores.%s' % _id] = score
+
+            if not current._apply(device, events):
+                return current
+
+            if cls.mongo().find_and_modify(query, update={'$set': {
+                    'start': current.start,
+                    'end': current.end,
+                    'winner': current.winner,
+                    'loser': current.loser,
+                    'timeline': current.timeline,
+                    'scores': current.scores,
+                    'sequences.%s' % device: current.sequences[device],
+                    'device_goals.%s' % device:
+                        current.device_goals.get(device, {}),
+                    }}):
+                if current.end and not query['end']:
+                    current._credit()
+                return current
+        raise cls.Error("That game is busy, try again.")
+
+    def _apply(self, device, events):
+        """ Applies sorted score events in memory. Returns whether any were
+            new.
 
-        game.winner = scorer
-        if game.players[0] == game.winner:
-            game.loser = game.players[1]
+        """
+        last = self.sequences.get(device)
+        changed = False
+        now = datetime.now()
+        for seq, scorer, stamp in events:
+            if last is not None and seq <= last:
+                continue
+            last = self.sequences[device] = seq
+            changed = True
+            if self.end or scorer not in self.players:
+                continue
+            # Bounce is judged on the device's own clock, and every event
+            # restarts the window so a chattering sensor counts once
+            goals = self.device_goals.setdefault(device, {})
+            previous, goals[scorer] = goals.get(scorer), stamp
+            if previous and abs((stamp - previous).total_seconds()) < \
+                    INGEST_DEBOUNCE:
+                continue
+            # Device clocks drift; keep the timeline in order and in the past
+            floor = self.timeline[-1][1] if self.timeline else self.start
+            stamp = min(max(stamp, floor or stamp), now)
+            self.start = self.start or stamp
+            self.timeline.append([scorer, stamp])
+            self.scores[scorer] += 1
+            if self.scores[scorer] >= 5:
+                self._decide(scorer, stamp)
+        return changed
+
+    def _decide(self, winner, end=None):
+        """ Ends the game with a winner. """
+        self.end = end or datetime.now()
+        self.winner = winner
+        if self.players[0] == self.winner:
+            self.loser = self.players[1]
         else:
-            game.loser = game.players[0]
+            self.loser = self.players[0]
 
-        loser = game.player(game.loser)
-        loser.points_for += game.scores[game.loser]
-        loser.points_against += game.scores[game.winner]
+    def _credit(self):
+        """ Updates the players' counters for a finished game, and anything
+            else waiting on the result.
+
+        """
+        playtime = (self.end - self.start).total_seconds()
+
+        loser = self.player(self.loser)
+        loser.points_for += self.scores[self.loser]
+        loser.points_against += self.scores[self.winner]
         loser.playtime += playtime
         loser.games += 1
         loser.losses += 1
-        loser.last_played = game.end
+        loser.last_played = self.end
 
-        winner = game.player(game.winner)
-        winner.points_for += game.scores[game.winner]
-        winner.points_against += game.scores[game.loser]
+        winner = self.player(self.winner)
+        winner.points_for += self.scores[self.winner]
+        winner.points_against += self.scores[self.loser]
         winner.playtime += playtime
         winner.games += 1
         winner.wins += 1
-        winner.last_played = game.end
+        winner.last_played = self.end
 
-        game = game.save()
         loser.save()
         winner.save()
 
-        return game
+        matchmaker.update(loser)
+        matchmaker.update(winner)
+
+        if self.tournament:
+            Tournament.advance(self)
 
     @classmethod
     def abort(cls, game):
@@ -315,14 +545,21 @@ class Game(ModelMixin, Model):
         game.loser = game.players[1]
         game.incomplete = True
         game.end = datetime.now()
-        playtime = (game.end - game.start).total_seconds()
+        if not cls.mongo().find_and_modify({'_id': game._id, 'end': None},
+                update=game):
+            raise cls.Error("Games can't end twice.")
 
-        for player in game.player1, game.player2:
+        # A scheduled game nobody started keeps no start and doesn't count
+        # against anyone
+        for player in (game.player1, game.player2) if game.start else ():
             player.incomplete += 1
-            player.playtime += playtime
+            player.playtime += (game.end - game.start).total_seconds()
             player.save()
 
-        return game.save()
+        if game.tournament:
+            Tournament.replay(game)
+
+        return game
 
     @classmethod
     def recent_games(cls, count=5):
@@ -332,6 +569,13 @@ class Game(ModelMixin, Model):
                 sort=[('start', -1)])
                         .limit(count))
 
+    @classmethod
+    def current(cls, player):
+        """ Returns the game in progress for a player id, if any. """
+        return cls.mongo().find_one(
+                {'players': player, 'start': {'$ne': None}, 'end': None},
+                sort=[('start', -1)])
+
     def _load_players(self):
         """ Loads players into local storage. """
         if not self.players:
@@ -386,6 +630,676 @@ class Game(ModelMixin, Model):
         pass
 
 
+class Tournament(ModelMixin, Model):
+    """ Tournament model.
+
+        Every match lives in the `matches` table, keyed by slot. Elimination
+        matches know where their winner, and in double elimination their
+        loser, goes next; a match gets a game once both its players are
+        known. Standings are updated as each game finishes rather than
+        recomputed from the games.
+
+    """
+    class Meta(object):
+        """ Minimongo settings. The collection is bound by :func:`connect`. """
+        interface = True
+
+    KINDS = ('round_robin', 'single', 'double')
+
+    def __init__(self, *args, **kwargs):
+        self.name = None
+        self.kind = 'round_robin'
+        self.players = []
+        self.matches = {}
+        self.final = None
+        self.standings = {}
+        self.winner = None
+        self.start = datetime.now()
+        self.end = None
+        self.version = 0
+        super(Tournament, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def fetch(cls, _id):
+        """ Fetches a tournament by id.
+
+            :param _id: Tournament._id to look up.
+            :returns: Tournament if found.
+            :raises: Tournament.Error if not found.
+
+        """
+        tournament = cls.one(_id=_id)
+        if not tournament:
+            raise cls.Error("Which tournament are you looking for?")
+        return tournament
+
+    @classmethod
+    def create(cls, name, kind, players):
+        """ Creates a tournament and schedules every game that can be
+            played yet, in one batch.
+
+            :param str name: Tournament name.
+            :param str kind: One of :attr:`Tournament.KINDS`.
+            :param list players: Player ids, best seed first.
+            :returns: Tournament instance created.
+
+        """
+        if not name:
+            raise cls.Error("What's it called?")
+        if kind not in cls.KINDS:
+            raise cls.Error("What kind of tournament is that?")
+        if not players or len(players) < 2:
+            raise cls.Error("A tournament needs players!")
+        if len(set(players)) != len(players):
+            raise cls.Error("Everybody only gets one entry.")
+        if Player.find(players, cursor=True).count() != len(players):
+            raise cls.Error("One or more players aren't really players.")
+
+        tournament = cls(_id=bson.ObjectId(), name=name, kind=kind,
+                players=players)
+        for _id in players:
+            tournament.standings[_id] = dict(played=0, wins=0, losses=0,
+                    points_for=0, points_against=0)
+
+        ready = []
+        if kind == 'round_robin':
+            tournament._round_robin(ready)
+        else:
+            tournament._elimination(kind == 'double', ready)
+        games = tournament._games(ready)
+
+        tournament = tournament.save()
+        Game.schedule(games)
+        return tournament
+
+    @classmethod
+    def advance(cls, game):
+        """ Records a finished tournament game: updates the standings,
+            moves its players through the bracket and schedules any games
+            that became playable.
+
+        """
+        def change(tournament, ready):
+            """ Records the result, unless it already has been. """
+            match = tournament.matches[game.slot]
+            if match['game'] == str(game._id) and not match['winner']:
+                tournament._record(game, ready)
+        return cls._update(game.tournament, change)
+
+    @classmethod
+    def replay(cls, game):
+        """ Schedules a new game for an aborted tournament game. """
+        def change(tournament, ready):
+            """ Reschedules the slot if it's still waiting on `game`. """
+            match = tournament.matches[game.slot]
+            if match['game'] == str(game._id) and not match['winner']:
+                ready.append(game.slot)
+        return cls._update(game.tournament, change)
+
+    @classmethod
+    def _update(cls, _id, change):
+        """ Applies ``change(tournament, ready)`` and saves it, retrying if
+            another game changed the tournament in the meantime. Games for
+            the `ready` slots are then scheduled in one batch.
+
+        """
+        for _ in range(TOURNAMENT_RETRIES):
+            tournament = cls.fetch(_id)
+            ready = []
+            change(tournament, ready)
+            games = tournament._games(ready)
+            version = tournament.version
+            tournament.version = version + 1
+            if cls.mongo().find_and_modify(
+                    {'_id': tournament._id, 'version': version},
+                    update=tournament):
+                Game.schedule(games)
+                return tournament
+        raise cls.Error("That tournament is busy, try again.")
+
+    def _add(self, slot, winner_to=None, loser_to=None):
+        """ Adds an empty match. `winner_to` and `loser_to` are
+            ``[slot, position]`` pairs.
+
+        """
+        self.matches[slot] = dict(players=[None, None], pending=2, game=None,
+                winner=None, loser=None, winner_to=winner_to,
+                loser_to=loser_to)
+
+    def _feed(self, slot, position, player, ready):
+        """ Puts a player, or a bye if `player` is None, into a match. """
+        match = self.matches[slot]
+        match['players'][position] = player
+        match['pending'] -= 1
+        if match['pending']:
+            return
+        if None not in match['players']:
+            ready.append(slot)
+            return
+        # A bye; whoever turned up goes through unplayed
+        self._decide(slot, match['players'][0] or match['players'][1], None,
+                ready)
+
+    def _decide(self, slot, winner, loser, ready):
+        """ Records a match result and moves its players on. """
+        match = self.matches[slot]
+        match['winner'] = winner
+        match['loser'] = loser
+        if match['winner_to']:
+            self._feed(match['winner_to'][0], match['winner_to'][1], winner,
+                    ready)
+        if match['loser_to']:
+            self._feed(match['loser_to'][0], match['loser_to'][1], loser,
+                    ready)
+        if slot == self.final:
+            self.winner = winner
+            self.end = datetime.now()
+
+    def _round_robin(self, ready):
+        """ Pairs everyone with everyone, in rounds, by the circle method. """
+        players = list(self.players)
+        if len(players) % 2:
+            players.append(None)
+        for round_ in range(1, len(players)):
+            for index in range(len(players) // 2):
+                pair = players[index], players[-1 - index]
+                if None in pair:
+                    continue
+                slot = 'R%d-%d' % (round_, index)
+                self._add(slot)
+                self._feed(slot, 0, pair[0], ready)
+                self._feed(slot, 1, pair[1], ready)
+            players.insert(1, players.pop())
+
+    def _elimination(self, double, ready):
+        """ Builds a seeded bracket, padded with byes for the top seeds.
+
+            Winners bracket slots are ``W<round>-<match>``. In double
+            elimination, losers drop into the ``L<round>-<match>`` slots and
+            the losers bracket champion meets the winners bracket champion
+            once, in slot ``F``.
+
+        """
+        rounds = 1
+        while 2 ** rounds < len(self.players):
+            rounds += 1
+        size = 2 ** rounds
+
+        for round_ in range(1, rounds + 1):
+            for index in range(size >> round_):
+                winner_to = loser_to = None
+                if round_ < rounds:
+                    winner_to = ['W%d-%d' % (round_ + 1, index // 2),
+                            index % 2]
+                elif double:
+                    winner_to = ['F', 0]
+                if double and rounds == 1:
+                    loser_to = ['F', 1]
+                elif double and round_ == 1:
+                    loser_to = ['L1-%d' % (index // 2), index % 2]
+                elif double:
+                    # Reversed to keep early opponents apart
+                    loser_to = ['L%d-%d' % (2 * (round_ - 1),
+                            (size >> round_) - 1 - index), 1]
+                self._add('W%d-%d' % (round_, index), winner_to, loser_to)
+
+        if double:
+            last = 2 * (rounds - 1)
+            for round_ in range(1, last + 1):
+                for index in range(size >> ((round_ + 1) // 2 + 1)):
+                    if round_ == last:
+                        winner_to = ['F', 1]
+                    elif round_ % 2:
+                        winner_to = ['L%d-%d' % (round_ + 1, index), 0]
+                    else:
+                        winner_to = ['L%d-%d' % (round_ + 1, index // 2),
+                                index % 2]
+                    self._add('L%d-%d' % (round_, index), winner_to)
+            self._add('F')
+            self.final = 'F'
+        else:
+            self.final = 'W%d-0' % rounds
+
+        # Seed order puts the best seeds furthest apart, e.g. 1v4 and 2v3
+        seeds = [0]
+        while len(seeds) < size:
+            seeds = [_ for seed in seeds for _ in (seed, 2 * len(seeds) - 1
+                - seed)]
+        players = list(self.players) + [None] * (size - len(self.players))
+        for position, seed in enumerate(seeds):
+            self._feed('W1-%d' % (position // 2), position % 2,
+                    players[seed], ready)
+
+    def _record(self, game, ready):
+        """ Adds a finished game to the standings and the matches table. """
+        for _id, other in ((game.winner, game.loser),
+                (game.loser, game.winner)):
+            row = self.standings[_id]
+            row['played'] += 1
+            row['wins' if _id == game.winner else 'losses'] += 1
+            row['points_for'] += game.scores[_id]
+            row['points_against'] += game.scores[other]
+        self._decide(game.slot, game.winner, game.loser, ready)
+        if not self.final and all(_['winner'] for _ in
+                self.matches.values()):
+            self.winner = self.table()[0]['player']
+            self.end = datetime.now()
+
+    def _games(self, ready):
+        """ Builds unsaved games for the `ready` slots. """
+        games = []
+        for slot in ready:
+            players = list(self.matches[slot]['players'])
+            game = Game(_id=bson.ObjectId(), players=players,
+                    scores=dict(zip(players, (0, 0))), start=None,
+                    tournament=str(self._id), slot=slot)
+            self.matches[slot]['game'] = str(game._id)
+            games.append(game)
+        return games
+
+    def table(self):
+        """ Returns the standings as a `list`, best first. """
+        rows = [dict(row, player=_id) for _id, row in
+                self.standings.items()]
+        return sorted(rows, key=lambda row: (-row['wins'],
+                row['points_against'] - row['points_for'], row['losses']))
+
+    class Error(BaseModelException):
+        """ Base class for Tournament exceptions. """
+        pass
+
+
+class Waiting(ModelMixin, Model):
+    """ A player waiting in the matchmaking queue. """
+    class Meta(object):
+        """ Minimongo settings. The collection is bound by :func:`connect`. """
+        interface = True
+
+    indices = (
+            Index('player', unique=True),
+            Index('skill'),
+            )
+
+    def __init__(self, *args, **kwargs):
+        self.player = None
+        self.skill = 0.5
+        self.since = datetime.now()
+        super(Waiting, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def join(cls, player):
+        """ Queues a player to play. If someone close enough in skill is
+            already waiting, both leave the queue and a game begins.
+
+            :param player: Player._id joining the queue.
+            :returns: :meth:`Waiting.status` for the player.
+
+        """
+        player = Player.fetch(player)
+        _id = str(player._id)
+        if Game.current(_id):
+            raise cls.Error("Finish your game first!")
+        if cls.mongo().find_one({'player': _id}):
+            return cls.status(_id)
+
+        skill = player.skill
+        recent = list(player.recent_opponents())
+        for _ in range(MATCH_RETRIES):
+            if cls._pair(_id, skill, recent):
+                break
+            try:
+                cls.mongo().update({'player': _id}, {'$setOnInsert': {
+                        'player': _id,
+                        'skill': skill,
+                        'since': datetime.now(),
+                        }}, upsert=True)
+            except DuplicateKeyError:
+                # A concurrent join for the same player queued them first
+                pass
+            waiting = cls.mongo().find_one({'player': _id})
+            if not waiting:
+                # Already claimed by someone else's join
+                break
+            # Two players joining at once can both find the queue empty and
+            # both queue up. The later one leaves again and pairs with the
+            # earlier one on the next pass.
+            earlier = {'_id': {'$lt': waiting._id}}
+            if not cls._candidates(skill, [_id], earlier):
+                break
+            if not cls.mongo().find_and_modify({'_id': waiting._id},
+                    remove=True):
+                break
+        return cls.status(_id)
+
+    @classmethod
+    def _pair(cls, player, skill, recent):
+        """ Begins a game between a player id and the best match waiting,
+            if there is one. Recent opponents are only paired again when
+            nobody else is waiting.
+
+            :returns: `bool`, whether a game began.
+
+        """
+        for exclude in (recent + [player], [player]):
+            opponent = cls._claim(skill, exclude)
+            if opponent:
+                Game.begin([opponent, player])
+                return True
+        return False
+
+    @classmethod
+    def _claim(cls, skill, exclude):
+        """ Removes and returns the closest waiting player id to `skill`
+            that's within their :meth:`tolerance`, if any.
+
+            Uses `find_and_modify` so two joins can't claim the same player.
+
+        """
+        while True:
+            candidates = cls._candidates(skill, exclude)
+            if not candidates:
+                return None
+            for waiting in candidates:
+                if cls.mongo().find_and_modify({'_id': waiting._id},
+                        remove=True):
+                    return waiting.player
+
+    @classmethod
+    def _candidates(cls, skill, exclude, query=None):
+        """ Returns the waiting players who'd accept someone of `skill`,
+            closest first.
+
+            Walks the skill index outwards, up to :data:`MATCH_SCAN` players
+            either side.
+
+        """
+        now = datetime.now()
+        query = dict(query or {}, player={'$nin': exclude})
+        candidates = []
+        for operator, direction in (('$gte', 1), ('$lt', -1)):
+            candidates.extend(cls.mongo().find(
+                    dict(query, skill={operator: skill}),
+                    sort=[('skill', direction)])
+                            .limit(MATCH_SCAN))
+        return sorted((_ for _ in candidates
+            if abs(_.skill - skill) <= _.tolerance(now)),
+                key=lambda w: abs(w.skill - skill))
+
+    def tolerance(self, now=None):
+        """ Widest skill gap this player will accept. Starts at
+            :data:`MATCH_TOLERANCE` and widens by :data:`MATCH_WIDEN` for
+            every minute spent waiting.
+
+        """
+        waited = ((now or datetime.now()) - self.since).total_seconds() / 60
+        return MATCH_TOLERANCE + MATCH_WIDEN * waited
+
+    @classmethod
+    def leave(cls, player):
+        """ Removes a player id from the queue. """
+        cls.mongo().remove({'player': player})
+        return cls.status(player)
+
+    @classmethod
+    def status(cls, player):
+        """ Returns whether a player id is waiting, and their current game. """
+        return {
+                'waiting': bool(cls.mongo().find_one({'player': player})),
+                'game': Game.current(player),
+                }
+
+    @classmethod
+    def queue(cls):
+        """ Returns everyone waiting, longest wait first. """
+        return list(cls.mongo().find(sort=[('since', 1)]))
+
+    class Error(BaseModelException):
+        """ Base class for Waiting exceptions. """
+        pass
+
+
+MODELS = (Player, Game, Tournament, Waiting)
+
+_connection = None
+_connection_lock = threading.Lock()
+
+
+def connect(host=None, port=None, database=None):
+    """ Binds every model in :data:`MODELS` to its MongoDB collection.
+
+        Models are declared as minimongo interfaces so that importing this
+        module never touches the network; the first database access calls
+        this instead. Subsequent calls are a no-op.
+
+        :param str host: MongoDB host. Defaults to :data:`DATABASE_HOST`.
+        :param int port: MongoDB port. Defaults to :data:`DATABASE_PORT`.
+        :param str database: Database name. Defaults to :data:`DATABASE`.
+        :returns: The pymongo connection.
+
+    """
+    global _connection
+    if _connection is not None:
+        return _connection
+    with _connection_lock:
+        if _connection is None:
+            import pymongo
+            from minimongo import Collection
+            connection = pymongo.Connection(host or DATABASE_HOST,
+                    port or DATABASE_PORT)
+            db = connection[database or DATABASE]
+            for model in MODELS:
+                model.connection = connection
+                model.database = db
+                model.collection = Collection(db, model.__name__.lower(),
+                        document_class=model)
+                for index in model.indices:
+                    index.ensure(model.collection)
+            _connection = connection
+    return _connection
+
+
+###############
+# Matchmaking #
+###############
+
+class Matchmaker(object):
+    """ Suggests balanced, fresh opponents.
+
+        Keeps every player in a list sorted by :attr:`Player.skill`, so the
+        closest opponents are found by bisecting and walking outwards rather
+        than by scanning every player. The index is rebuilt from the
+        database every :data:`MATCH_REFRESH` seconds, and updated in place
+        when this process finishes a game.
+
+    """
+    fields = ('wins', 'games', 'points_for', 'points_against', 'last_played')
+
+    def __init__(self, refresh=MATCH_REFRESH):
+        self.refresh = refresh
+        self.built = 0
+        self.keys = []
+        self.players = {}
+        self.lock = threading.Lock()
+
+    def load(self, players):
+        """ Replaces the index with `players`. """
+        keys = []
+        lookup = {}
+        for player in players:
+            _id = str(player._id)
+            keys.append((player.skill, _id))
+            lookup[_id] = (player.skill, player.last_played)
+        keys.sort()
+        with self.lock:
+            self.keys = keys
+            self.players = lookup
+            self.built = time.time()
+
+    def ensure(self):
+        """ Rebuilds the index from the database if it's stale. """
+        if time.time() - self.built > self.refresh:
+            self.load(Player.mongo().find(fields=self.fields))
+
+    def update(self, player):
+        """ Moves a player to their current skill in the index. """
+        _id = str(player._id)
+        with self.lock:
+            # Copy so concurrent readers never see a half-moved list
+            keys = list(self.keys)
+            if _id in self.players:
+                old = (self.players[_id][0], _id)
+                index = bisect.bisect_left(keys, old)
+                if index < len(keys) and keys[index] == old:
+                    del keys[index]
+            bisect.insort(keys, (player.skill, _id))
+            self.players[_id] = (player.skill, player.last_played)
+            self.keys = keys
+
+    def nearest(self, skill, exclude=(), limit=MATCH_SCAN):
+        """ Returns up to `limit` ``(distance, _id)`` pairs closest to
+            `skill`, nearest first, skipping ids in `exclude`.
+
+        """
+        keys = self.keys
+        high = bisect.bisect_left(keys, (skill, ''))
+        low = high - 1
+        found = []
+        while len(found) < limit and (low >= 0 or high < len(keys)):
+            if high >= len(keys) or (low >= 0 and
+                    skill - keys[low][0] <= keys[high][0] - skill):
+                key, low = keys[low], low - 1
+            else:
+                key, high = keys[high], high + 1
+            if key[1] not in exclude:
+                found.append((abs(key[0] - skill), key[1]))
+        return found
+
+    def suggest(self, player, count=3):
+        """ Returns up to `count` suggested opponent ids for `player`.
+
+            Candidates are the closest in skill who aren't recent opponents;
+            among similarly balanced candidates, whoever has gone longest
+            without a game comes first.
+
+        """
+        self.ensure()
+        exclude = player.recent_opponents()
+        exclude.add(str(player._id))
+        candidates = self.nearest(player.skill, exclude)
+        players = self.players
+        # Never played sorts first; None doesn't compare with datetimes
+        candidates.sort(key=lambda c: (round(c[0], 2),
+                players.get(c[1], (None, None))[1] or datetime.min))
+        return [_id for _, _id in candidates[:count]]
+
+
+matchmaker = Matchmaker()
+
+
+#############
+# Ingestion #
+#############
+
+class IngestError(FoosException):
+    """ Raised when a batch of score events is rejected. """
+
+
+class RateLimited(IngestError):
+    """ Raised when a device sends events faster than allowed. """
+
+
+class RateLimiter(object):
+    """ Token bucket per key. Each key may spend `burst` tokens at once,
+        refilled at `rate` tokens per second.
+
+    """
+    def __init__(self, rate, burst, limit):
+        self.rate = rate
+        self.burst = burst
+        self.limit = limit
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def allow(self, key, cost=1):
+        """ Spends `cost` tokens for `key` if it has them. At most `limit`
+            keys are tracked; new keys are refused while that many are
+            mid-burst.
+
+        """
+        now = time.time()
+        with self.lock:
+            if key not in self.buckets and len(self.buckets) >= self.limit:
+                self._prune(now)
+                if len(self.buckets) >= self.limit:
+                    return False
+            tokens, stamp = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.buckets[key] = (tokens, now)
+        return allowed
+
+    def _prune(self, now):
+        """ Forgets keys whose buckets have refilled, which is the same as
+            never having seen them.
+
+        """
+        for key, (tokens, stamp) in self.buckets.items():
+            if tokens + (now - stamp) * self.rate >= self.burst:
+                del self.buckets[key]
+
+
+ingest_limiter = RateLimiter(INGEST_RATE, INGEST_BURST, INGEST_DEVICES)
+
+
+def ingest(device, events):
+    """ Applies a batch of score events from a device, with one write per
+        game. See :meth:`Game.ingest`.
+
+        :param str device: Id of the sending device.
+        :param list events: At most :data:`INGEST_BATCH` dicts with
+            `game`, `scorer`, a client `seq` number and the `time` it was
+            scored in seconds since the epoch.
+        :returns: `dict` by game id of the updated game, or of an `error`
+            for a game that couldn't be updated.
+        :raises: :exc:`RateLimited` if the device is sending too fast.
+
+    """
+    if not isinstance(device, basestring) or not device or \
+            '.' in device or device.startswith('$'):
+        raise IngestError("Which device is this?")
+    if not events or not isinstance(events, list):
+        raise IngestError("No events?")
+    if len(events) > INGEST_BATCH:
+        raise IngestError("Send at most %d events at a time." % INGEST_BATCH)
+    if not ingest_limiter.allow(device, len(events)):
+        raise RateLimited("Slow down!")
+
+    oldest = time.time() - INGEST_MAX_AGE
+    games = {}
+    for event in events:
+        try:
+            # Debouncing needs the device's own clock, so `time` is required
+            stamp = float(event['time'])
+            if stamp < oldest:
+                raise ValueError(stamp)
+            stamp = datetime.fromtimestamp(stamp)
+            games.setdefault(str(event['game']), []).append(
+                    (int(event['seq']), str(event['scorer']), stamp))
+        except (AttributeError, KeyError, TypeError, ValueError,
+                OverflowError):
+            raise IngestError("Invalid event.")
+
+    results = {}
+    for _id, batch in games.items():
+        try:
+            results[_id] = Game.ingest(_id, device, batch)
+        except Game.Error, exc:
+            results[_id] = {'error': exc.message}
+    return results
+
+
 ###########
 # Helpers #
 ###########
@@ -483,6 +1397,47 @@ def catch_template(func):
     return wrapped
 
 
+##########
+# Routes #
+##########
+
+class Routes(list):
+    """ A table of routes, bound to an app by :func:`make_app`.
+
+        Registering routes on bottle's default app at import time leaks
+        state into every importer, so controllers are collected here and
+        only attached when an app is actually built.
+
+    """
+    def route(self, path, method='GET'):
+        """ Decorator recording a route. """
+        def decorator(func):
+            """ Records `func` and returns it unchanged. """
+            self.append((path, method, func))
+            return func
+        return decorator
+
+    def get(self, path):
+        """ Decorator recording a GET route. """
+        return self.route(path, 'GET')
+
+    def post(self, path):
+        """ Decorator recording a POST route. """
+        return self.route(path, 'POST')
+
+    def bind(self, app):
+        """ Attaches every recorded route to `app`. """
+        for path, method, func in self:
+            app.route(path, method, func)
+        return app
+
+
+site_routes = Routes()
+api_routes = Routes()
+
+get, post = site_routes.get, site_routes.post
+
+
 ###############
 # Controllers #
 ###############
@@ -589,8 +1544,8 @@ def show_players():
 # API #
 #######
 
-# Push default app stack to create new JSON API app
-bottle.default_app.push()
+# Following routes belong to the JSON API app
+get, post = api_routes.get, api_routes.post
 
 
 # Player API methods #
@@ -616,9 +1571,24 @@ def api_description():
             '/player/<player>/recent/<count>': {
                 'description': api_player_recent_games.__doc__,
                 },
+            '/player/<player>/suggest/<count>': {
+                'description': api_player_suggest.__doc__,
+                },
             '/game/<game>': {
                 'description': api_game.__doc__,
                 },
+            '/tournament/<tournament>': {
+                'description': api_tournament.__doc__,
+                },
+            '/tournament/<tournament>/standings': {
+                'description': api_tournament_standings.__doc__,
+                },
+            '/queue': {
+                'description': api_queue.__doc__,
+                },
+            '/queue/<player>': {
+                'description': api_queue_status.__doc__,
+                },
             },
         'POST': {
             '/player/create': {
@@ -639,6 +1609,20 @@ def api_description():
             '/game/<game>/abort': {
                 'description': api_game_abort.__doc__,
                 },
+            '/events': {
+                'params': ['device', 'events'],
+                'description': api_events.__doc__,
+                },
+            '/tournament/create': {
+                'params': ['name', 'kind', 'players'],
+                'description': api_tournament_create.__doc__,
+                },
+            '/queue/<player>': {
+                'description': api_queue_join.__doc__,
+                },
+            '/queue/<player>/leave': {
+                'description': api_queue_leave.__doc__,
+                },
             },
         })
 
@@ -695,6 +1679,17 @@ def api_player_recent_games(player, count):
     return as_json(games)
 
 
+@get('/player/<player>/suggest/<count>')
+@catch_json
+def api_player_suggest(player, count):
+    """ Suggests `count` balanced opponents for a player. """
+    count = validate(count, int)
+    player = Player.fetch(player)
+    suggested = matchmaker.suggest(player, count)
+    players = dict((str(_['_id']), _) for _ in Player.find(suggested))
+    return as_json([players[_] for _ in suggested if _ in players])
+
+
 # Game API methods #
 @get('/game/<game>')
 @catch_json
@@ -732,8 +1727,163 @@ def api_game_abort(game):
     return as_json(Game.abort(game))
 
 
-# Retrieve JSON API app to mount
-json_api_app = bottle.default_app.pop()
+@post('/events')
+@catch_json
+def api_events():
+    """ Records a JSON batch of score events from a device. """
+    batch = request.json
+    if not isinstance(batch, dict):
+        batch = {}
+    try:
+        return as_json(ingest(batch.get('device'), batch.get('events')))
+    except RateLimited, exc:
+        response.status = 429
+        return error_json(exc.message)
+
+
+# Tournament API methods #
+@post('/tournament/create')
+@catch_json
+def api_tournament_create():
+    """ Creates a tournament and schedules its first games. """
+    return as_json(Tournament.create(request.POST.name, request.POST.kind,
+        request.POST.dict.get('players', None)))
+
+
+@get('/tournament/<tournament>')
+@catch_json
+def api_tournament(tournament):
+    """ Returns a tournament, with its matches. """
+    return as_json(Tournament.fetch(tournament))
+
+
+@get('/tournament/<tournament>/standings')
+@catch_json
+def api_tournament_standings(tournament):
+    """ Returns a tournament's standings, best first. """
+    return as_json(Tournament.fetch(tournament).table())
+
+
+# Queue API methods #
+@get('/queue')
+def api_queue():
+    """ Lists players waiting to play. """
+    return as_json(Waiting.queue())
+
+
+@get('/queue/<player>')
+@catch_json
+def api_queue_status(player):
+    """ Returns whether a player is waiting, and their current game. """
+    return as_json(Waiting.status(player))
+
+
+@post('/queue/<player>')
+@catch_json
+def api_queue_join(player):
+    """ Waits to play. Starts a game if a good match is already waiting. """
+    return as_json(Waiting.join(player))
+
+
+@post('/queue/<player>/leave')
+@catch_json
+def api_queue_leave(player):
+    """ Stops waiting to play. """
+    return as_json(Waiting.leave(player))
+
+
+###############
+# Maintenance #
+###############
+
+def _disconnect():
+    """ Drops the connection inherited from a parent process. """
+    global _connection
+    _connection = None
+
+
+def _audit_chunk(task):
+    """ Audits a chunk of players in a worker process.
+
+        :param tuple task: ``(player ids, repair)``.
+        :returns: ``(count, results)``, where each result is
+            ``(player id, name, drift, repaired)``.
+
+    """
+    ids, repair = task
+    results = []
+    for player in Player.find(ids, cursor=True):
+        drift = player.drift()
+        if not drift:
+            continue
+        repaired = False
+        if repair:
+            # Only repair if nothing was played since the tally
+            query = dict((key, stored) for key, (stored, _) in drift.items())
+            query['_id'] = player._id
+            repaired = bool(Player.mongo().find_and_modify(query,
+                update={'$set': dict((key, actual) for key, (_, actual) in
+                    drift.items())}))
+        results.append((str(player._id), player.name, drift, repaired))
+    return len(ids), results
+
+
+def audit(repair=False, processes=None):
+    """ Recomputes every player's counters from the games, across a process
+        pool, yielding ``(count, results)`` per chunk as in
+        :func:`_audit_chunk`.
+
+        :param bool repair: Overwrite counters that have drifted.
+        :param int processes: Pool size. Defaults to the number of CPUs.
+
+    """
+    import multiprocessing
+
+    ids = [str(_['_id']) for _ in Player.mongo().find(fields=('_id',))]
+    tasks = [(ids[_:_ + AUDIT_CHUNK], repair)
+            for _ in range(0, len(ids), AUDIT_CHUNK)]
+
+    pool = multiprocessing.Pool(processes, initializer=_disconnect)
+    try:
+        for result in pool.imap_unordered(_audit_chunk, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def audit_command(argv):
+    """ ``python foos.py audit [--repair] [--processes N]``
+
+        Reports players whose counters have drifted from their games.
+        Exits non-zero if any drift is left unrepaired.
+
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='foos.py audit',
+            description="Check player counters against their games.")
+    parser.add_argument('--repair', action='store_true',
+            help="overwrite counters that have drifted")
+    parser.add_argument('--processes', type=int, default=None,
+            help="worker processes (default: number of CPUs)")
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    audited = drifted = repaired = 0
+    for count, results in audit(args.repair, args.processes):
+        audited += count
+        for _id, name, drift, fixed in results:
+            drifted += 1
+            repaired += fixed
+            # Names are unicode, and a piped stdout only takes ascii
+            sys.stdout.write(("%s (%s)%s\n" % (name, _id,
+                " repaired" if fixed else "")).encode('utf-8'))
+            for key in sorted(drift):
+                sys.stdout.write("    %s: %s -> %s\n" % ((key,) + drift[key]))
+
+    sys.stdout.write("Audited %d players in %.1fs: %d drifted, %d repaired\n"
+            % (audited, time.time() - start, drifted, repaired))
+    return 1 if drifted > repaired else 0
 
 
 ########
@@ -741,20 +1891,27 @@ json_api_app = bottle.default_app.pop()
 ########
 
 def make_app(serve_static=True, json_api=True):
-    """ Builds the WSGI app. """
-    foos_app = bottle.default_app()
+    """ Builds the WSGI app.
+
+        Nothing is built at import time; WSGI servers should call this
+        factory (e.g. ``gunicorn 'foos:make_app()'``). The database
+        connection is deferred until the first request touches a model, and
+        bottle compiles each template on its first render.
+
+    """
+    foos_app = site_routes.bind(bottle.Bottle())
 
     if serve_static:
+        import static
         foos_app.mount(STATIC_MOUNT, static.Cling('./static'))
 
     if json_api:
-        foos_app.mount(API_MOUNT, json_api_app)
+        foos_app.mount(API_MOUNT, api_routes.bind(bottle.Bottle()))
 
     return foos_app
 
 
-app = make_app()
-
-
 if __name__ == '__main__':
-    bottle.run(app=app, host='0.0.0.0', port=8080, server='auto')
+    if sys.argv[1:2] == ['audit']:
+        sys.exit(audit_command(sys.argv[2:]))
+    bottle.run(app=make_app(), host='0.0.0.0', port=8080, server='auto')
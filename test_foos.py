@@ -0,0 +1,568 @@
+"""
+Foos Tests
+
+Run with ``python -m unittest test_foos``. Models are bound to in-memory
+collections, so no MongoDB is needed.
+
+"""
+import io
+import os
+import sys
+import time
+import random
+import unittest
+import subprocess
+from datetime import datetime, timedelta
+
+import bson
+
+import foos
+
+_MISSING = object()
+
+
+def _plain(obj):
+    """ Copies nested dicts and lists into plain containers. """
+    if isinstance(obj, dict):
+        return dict((key, _plain(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [_plain(_) for _ in obj]
+    return obj
+
+
+def _get(doc, path):
+    """ Looks up a dotted path in a document. """
+    for key in path.split('.'):
+        if not isinstance(doc, dict) or key not in doc:
+            return _MISSING
+        doc = doc[key]
+    return doc
+
+
+def _set(doc, path, value):
+    """ Sets a dotted path in a document. """
+    keys = path.split('.')
+    for key in keys[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[keys[-1]] = _plain(value)
+
+
+def _equals(value, expected):
+    """ Mongo equality, where a list matches any of its items. """
+    if value is _MISSING:
+        return expected is None
+    if isinstance(value, list) and not isinstance(expected, list):
+        return expected in value
+    return value == expected
+
+
+def _matches(doc, query):
+    """ Whether a document matches a query. """
+    for path, condition in (query or {}).items():
+        value = _get(doc, path)
+        if not (isinstance(condition, dict) and condition and
+                all(_.startswith('$') for _ in condition)):
+            if not _equals(value, condition):
+                return False
+            continue
+        for operator, operand in condition.items():
+            if operator == '$exists':
+                ok = (value is not _MISSING) == operand
+            elif operator == '$ne':
+                ok = not _equals(value, operand)
+            elif operator == '$in':
+                ok = any(_equals(value, _) for _ in operand)
+            elif operator == '$nin':
+                ok = not any(_equals(value, _) for _ in operand)
+            elif value is _MISSING:
+                ok = False
+            elif operator == '$gt':
+                ok = value > operand
+            elif operator == '$gte':
+                ok = value >= operand
+            elif operator == '$lt':
+                ok = value < operand
+            elif operator == '$lte':
+                ok = value <= operand
+            else:
+                raise NotImplementedError(operator)
+            if not ok:
+                return False
+    return True
+
+
+def _apply(doc, update, inserting=False):
+    """ Applies an update document, or replaces `doc` with it. """
+    if not any(_.startswith('$') for _ in update):
+        _id = doc['_id']
+        doc.clear()
+        doc.update(_plain(update))
+        doc['_id'] = _id
+        return
+    for path, value in update.get('$set', {}).items():
+        _set(doc, path, value)
+    for path, value in update.get('$inc', {}).items():
+        current = _get(doc, path)
+        _set(doc, path, (0 if current is _MISSING else current) + value)
+    if inserting:
+        for path, value in update.get('$setOnInsert', {}).items():
+            _set(doc, path, value)
+
+
+class FakeCursor(object):
+    """ The parts of a pymongo cursor the app uses. """
+    def __init__(self, docs):
+        self.docs = docs
+
+    def limit(self, count):
+        """ Limits the results. """
+        return FakeCursor(self.docs[:count] if count else self.docs)
+
+    def count(self):
+        """ Counts the results. """
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+class FakeCollection(object):
+    """ The parts of a minimongo collection the app uses, in memory. """
+    def __init__(self, document_class):
+        self.document_class = document_class
+        self.docs = []
+
+    def _find(self, query=None, sort=None):
+        """ Matching stored documents, sorted. """
+        docs = [_ for _ in self.docs if _matches(_, query)]
+        for key, direction in reversed(sort or []):
+            docs.sort(key=lambda doc: _get(doc, key), reverse=direction < 0)
+        return docs
+
+    def find(self, query=None, sort=None, fields=None):
+        """ Finds documents, wrapped in the document class. """
+        return FakeCursor([self.document_class(_plain(_))
+            for _ in self._find(query, sort)])
+
+    def find_one(self, query=None, sort=None):
+        """ Finds the first matching document. """
+        docs = self._find(query, sort)
+        return self.document_class(_plain(docs[0])) if docs else None
+
+    def insert(self, docs):
+        """ Inserts a document or a list of them. """
+        for doc in docs if isinstance(docs, list) else [docs]:
+            doc.setdefault('_id', bson.ObjectId())
+            self.docs.append(_plain(doc))
+
+    def save(self, doc):
+        """ Inserts or replaces a document. """
+        doc.setdefault('_id', bson.ObjectId())
+        self.remove({'_id': doc['_id']})
+        self.docs.append(_plain(doc))
+
+    def update(self, query, update, upsert=False):
+        """ Updates the first matching document. """
+        docs = self._find(query)
+        if docs:
+            _apply(docs[0], update)
+        elif upsert:
+            doc = dict((key, value) for key, value in query.items()
+                    if not isinstance(value, dict))
+            doc['_id'] = bson.ObjectId()
+            _apply(doc, update, inserting=True)
+            self.docs.append(doc)
+
+    def find_and_modify(self, query, update=None, remove=False):
+        """ Updates or removes the first match, returning it as it was. """
+        docs = self._find(query)
+        if not docs:
+            return None
+        before = self.document_class(_plain(docs[0]))
+        if remove:
+            self.docs.remove(docs[0])
+        else:
+            _apply(docs[0], update)
+        return before
+
+    def remove(self, query):
+        """ Removes matching documents. """
+        self.docs = [_ for _ in self.docs if not _matches(_, query)]
+
+    def ensure_index(self, *args, **kwargs):
+        """ Indices don't matter in memory. """
+
+
+class FoosTestCase(unittest.TestCase):
+    """ Binds every model to an empty in-memory collection. """
+    def setUp(self):
+        self._saved = (foos._connection, foos.matchmaker,
+                foos.ingest_limiter,
+                [_.__dict__.get('collection') for _ in foos.MODELS])
+        foos._connection = 'fake'
+        foos.matchmaker = foos.Matchmaker()
+        foos.ingest_limiter = foos.RateLimiter(foos.INGEST_RATE,
+                foos.INGEST_BURST, foos.INGEST_DEVICES)
+        for model in foos.MODELS:
+            model.collection = FakeCollection(model)
+
+    def tearDown(self):
+        (foos._connection, foos.matchmaker, foos.ingest_limiter,
+                collections) = self._saved
+        for model, collection in zip(foos.MODELS, collections):
+            model.collection = collection
+
+    def player(self, name, **kwargs):
+        """ Creates a player. """
+        return foos.Player(name=name, **kwargs).save()
+
+
+class TestApp(unittest.TestCase):
+    def test_make_app_needs_no_database(self):
+        code = ("import foos\n"
+                "from minimongo.collection import DummyCollection\n"
+                "foos.make_app(serve_static=False)\n"
+                "print foos._connection is None, "
+                "foos.Player.collection is DummyCollection\n")
+        output = subprocess.check_output([sys.executable, '-c', code],
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.split(), ['True', 'True'])
+
+
+class TestPlayer(FoosTestCase):
+    def test_create_and_rename(self):
+        player = foos.Player.create('Alice')
+        self.assertRaises(foos.Player.DupeError, foos.Player.create, 'Alice')
+        foos.Player.fetch(str(player._id)).rename('Bob')
+        self.assertEqual(foos.Player.fetch(str(player._id)).name, 'Bob')
+
+
+class TestMatchmaking(FoosTestCase):
+    def test_suggest_orders_never_played_first(self):
+        now = datetime.now()
+        me = self.player('me')
+        played = self.player('played', last_played=now)
+        fresh = self.player('fresh')
+        foos.matchmaker.load(foos.Player.find())
+        self.assertEqual(foos.matchmaker.suggest(me, 2),
+                [str(fresh._id), str(played._id)])
+
+    def test_suggest_skips_recent_opponents(self):
+        me = self.player('me')
+        rival = self.player('rival')
+        other = self.player('other', wins=3, games=3, points_for=15)
+        foos.Game.begin([str(me._id), str(rival._id)])
+        foos.matchmaker.load(foos.Player.find())
+        self.assertEqual(foos.matchmaker.suggest(me), [str(other._id)])
+
+    def test_join_waits_then_pairs(self):
+        first = self.player('first')
+        second = self.player('second')
+        status = foos.Waiting.join(str(first._id))
+        self.assertTrue(status['waiting'])
+        self.assertEqual(foos.Waiting.join(str(first._id)), status)
+        status = foos.Waiting.join(str(second._id))
+        self.assertFalse(status['waiting'])
+        self.assertEqual(sorted(status['game'].players),
+                sorted([str(first._id), str(second._id)]))
+        self.assertEqual(foos.Waiting.queue(), [])
+
+    def test_join_pairs_with_concurrent_earlier_join(self):
+        first = self.player('first')
+        second = self.player('second')
+        # First queued while second was looking at an empty queue
+        pair = foos.Waiting.__dict__['_pair']
+
+        def racing_pair(player, skill, recent):
+            """ Sees the queue as empty the first time. """
+            foos.Waiting._pair = pair
+            foos.Waiting.collection.insert({'player': str(first._id),
+                'skill': 0.5, 'since': datetime.now(),
+                '_id': bson.ObjectId.from_datetime(
+                    datetime.utcnow() - timedelta(seconds=1))})
+            return False
+        foos.Waiting._pair = staticmethod(racing_pair)
+        try:
+            status = foos.Waiting.join(str(second._id))
+        finally:
+            foos.Waiting._pair = pair
+        self.assertFalse(status['waiting'])
+        self.assertTrue(status['game'])
+        self.assertEqual(foos.Waiting.queue(), [])
+
+    def test_mismatched_players_wait(self):
+        strong = self.player('strong', games=50, wins=50, points_for=250)
+        weak = self.player('weak', games=50, losses=50,
+                points_against=250)
+        peer = self.player('peer', games=50, wins=50, points_for=250)
+        foos.Waiting.join(str(strong._id))
+        self.assertTrue(foos.Waiting.join(str(weak._id))['waiting'])
+        status = foos.Waiting.join(str(peer._id))
+        self.assertEqual(sorted(status['game'].players),
+                sorted([str(strong._id), str(peer._id)]))
+        self.assertEqual([_.player for _ in foos.Waiting.queue()],
+                [str(weak._id)])
+
+    def test_tolerance_widens_while_waiting(self):
+        strong = self.player('strong', games=50, wins=50, points_for=250)
+        weak = self.player('weak', games=50, losses=50,
+                points_against=250)
+        foos.Waiting.join(str(weak._id))
+        foos.Waiting.collection.update({'player': str(weak._id)},
+                {'$set': {'since': datetime.now() - timedelta(hours=1)}})
+        status = foos.Waiting.join(str(strong._id))
+        self.assertFalse(status['waiting'])
+        self.assertTrue(status['game'])
+
+
+class TestTournament(FoosTestCase):
+    def play_out(self, tournament, rng):
+        """ Plays scheduled games in random order until the tournament
+            ends. Returns the number of games played.
+
+        """
+        played = 0
+        while True:
+            games = list(foos.Game.mongo().find(
+                {'tournament': str(tournament._id), 'end': None}))
+            if not games:
+                return played
+            game = rng.choice(games)
+            winner = rng.choice(game.players)
+            for _ in range(5):
+                foos.Game.play(str(game._id), winner)
+            played += 1
+
+    def check(self, kind, size, expected):
+        """ Plays out a tournament and checks it has a single winner. """
+        rng = random.Random(size)
+        players = [str(self.player('p%d' % _)._id) for _ in range(size)]
+        tournament = foos.Tournament.create('Cup', kind, players)
+        played = self.play_out(tournament, rng)
+        tournament = foos.Tournament.fetch(tournament._id)
+        self.assertEqual(played, expected, (kind, size))
+        self.assertIn(tournament.winner, players)
+        self.assertTrue(tournament.end)
+        self.assertEqual(tournament.table()[0]['player'] if kind ==
+                'round_robin' else tournament.winner, tournament.winner)
+        self.assertEqual(sum(_['played'] for _ in tournament.table()),
+                2 * played)
+        if kind == 'single':
+            self.assertEqual(tournament.standings[tournament.winner].losses,
+                    0)
+
+    def test_round_robin(self):
+        for size in range(2, 10):
+            self.check('round_robin', size, size * (size - 1) // 2)
+
+    def test_single_elimination(self):
+        for size in range(2, 18):
+            self.check('single', size, size - 1)
+
+    def test_double_elimination(self):
+        for size in range(2, 18):
+            self.check('double', size, 2 * size - 2)
+
+    def test_abort_unstarted_game(self):
+        players = [str(self.player(_)._id) for _ in ('a', 'b')]
+        tournament = foos.Tournament.create('Cup', 'single', players)
+        game = foos.Game.mongo().find_one({'tournament': str(tournament._id)})
+        foos.Game.abort(str(game._id))
+        for player in foos.Player.find(players):
+            self.assertEqual((player.incomplete, player.playtime), (0, 0))
+        replay = foos.Game.mongo().find_one(
+                {'tournament': str(tournament._id), 'end': None})
+        self.assertEqual(foos.Tournament.fetch(tournament._id).matches[
+            replay.slot].game, str(replay._id))
+
+    def test_busy_tournament(self):
+        players = [str(self.player(_)._id) for _ in ('a', 'b')]
+        tournament = foos.Tournament.create('Cup', 'single', players)
+        foos.Tournament.collection.find_and_modify = lambda *a, **k: None
+        self.assertRaises(foos.Tournament.Error, foos.Tournament.replay,
+                foos.Game.mongo().find_one())
+
+    def test_advance_twice(self):
+        players = [str(self.player('p%d' % _)._id) for _ in range(4)]
+        tournament = foos.Tournament.create('Cup', 'single', players)
+        game = foos.Game.mongo().find_one({'tournament': str(tournament._id)})
+        for _ in range(5):
+            foos.Game.play(str(game._id), game.players[0])
+        foos.Tournament.advance(foos.Game.fetch(game._id))
+        tournament = foos.Tournament.fetch(tournament._id)
+        self.assertEqual(tournament.standings[game.players[0]].played, 1)
+        self.assertEqual(tournament.matches[tournament.final].pending, 1)
+
+    def test_final_goal_credited_once(self):
+        players = [str(self.player(_)._id) for _ in ('a', 'b')]
+        game = foos.Game.begin(players)
+        for _ in range(4):
+            foos.Game.play(str(game._id), players[0])
+        # A second scorer read the game before the winning goal landed
+        stale = foos.Game.fetch(game._id)
+        foos.Game.play(str(game._id), players[0])
+        fetch = foos.Game.__dict__['fetch']
+        foos.Game.fetch = classmethod(lambda cls, _id: stale)
+        try:
+            self.assertRaises(foos.Game.GameOver, foos.Game.play,
+                    str(game._id), players[0])
+        finally:
+            foos.Game.fetch = fetch
+        self.assertEqual(foos.Player.fetch(players[0]).wins, 1)
+
+
+class TestIngest(FoosTestCase):
+    def setUp(self):
+        super(TestIngest, self).setUp()
+        self.players = [str(self.player(_)._id) for _ in ('a', 'b')]
+        self.game = foos.Game.begin(self.players)
+
+    def events(self, scorer, count, start=1, when=None, game=None):
+        """ Score events `INGEST_DEBOUNCE` apart. """
+        when = when or time.time() - 60
+        return [dict(game=str(game or self.game._id), scorer=scorer,
+            seq=start + _, time=when + _ * 2 * foos.INGEST_DEBOUNCE)
+            for _ in range(count)]
+
+    def test_retries_are_deduplicated(self):
+        events = self.events(self.players[0], 3)
+        foos.ingest('sensor', events)
+        game = foos.ingest('sensor', events)[str(self.game._id)]
+        self.assertEqual(game.scores[self.players[0]], 3)
+        self.assertEqual(game.sequences['sensor'], 3)
+
+    def test_bounce_is_ignored(self):
+        events = self.events(self.players[0], 2)
+        events[1]['time'] = events[0]['time'] + foos.INGEST_DEBOUNCE / 2
+        game = foos.ingest('sensor', events)[str(self.game._id)]
+        self.assertEqual(game.scores[self.players[0]], 1)
+
+    def test_oversized_batch(self):
+        events = self.events(self.players[0], foos.INGEST_BATCH + 1)
+        try:
+            foos.ingest('sensor', events)
+        except foos.RateLimited:
+            self.fail("Oversized batch was rate limited")
+        except foos.IngestError, exc:
+            self.assertIn(str(foos.INGEST_BATCH), exc.message)
+        else:
+            self.fail("Oversized batch was accepted")
+        foos.ingest('sensor', events[:foos.INGEST_BATCH])
+
+    def test_implausible_time(self):
+        events = self.events(self.players[0], 1)
+        events[0]['time'] = 0
+        self.assertRaises(foos.IngestError, foos.ingest, 'sensor', events)
+
+    def test_untimed_events(self):
+        events = self.events(self.players[0], 3)
+        for event in events:
+            del event['time']
+        self.assertRaises(foos.IngestError, foos.ingest, 'sensor', events)
+        self.assertEqual(foos.Game.fetch(self.game._id).scores[
+            self.players[0]], 0)
+
+    def test_clock_behind_game_start(self):
+        behind = time.mktime((self.game.start - timedelta(hours=1))
+                .timetuple())
+        game = foos.ingest('sensor', self.events(self.players[1], 5,
+            when=behind))[str(self.game._id)]
+        self.assertEqual(game.winner, self.players[1])
+        self.assertTrue(game.start <= game.end)
+        for player in foos.Player.find(self.players):
+            self.assertTrue(player.playtime >= 0)
+
+    def test_unknown_game_reported_per_game(self):
+        missing = str(bson.ObjectId())
+        events = self.events(self.players[0], 1) + self.events(
+                self.players[0], 1, start=2, game=missing)
+        results = foos.ingest('sensor', events)
+        self.assertEqual(results[str(self.game._id)].scores[
+            self.players[0]], 1)
+        self.assertIn('error', results[missing])
+
+    def test_limiter_forgets_idle_devices(self):
+        limiter = foos.RateLimiter(rate=10, burst=10, limit=2)
+        self.assertTrue(limiter.allow('a', 10))
+        self.assertTrue(limiter.allow('b', 10))
+        self.assertFalse(limiter.allow('c'))
+        limiter.buckets['a'] = (0, time.time() - 1)
+        self.assertTrue(limiter.allow('c'))
+        self.assertEqual(sorted(limiter.buckets), ['b', 'c'])
+
+
+class TestAudit(FoosTestCase):
+    def setUp(self):
+        super(TestAudit, self).setUp()
+        self.a = self.player('a')
+        self.b = self.player('b')
+        players = [str(self.a._id), str(self.b._id)]
+        start = datetime(2026, 1, 1, 12)
+        self.end = start + timedelta(minutes=5)
+        foos.Game.mongo().insert([
+            # a beats b 5-3, then an abandoned game, then b beats a 5-1
+            foos.Game(players=players, scores=dict(zip(players, (5, 3))),
+                start=start, end=start + timedelta(minutes=3),
+                winner=players[0], loser=players[1]),
+            foos.Game(players=players, scores=dict(zip(players, (0, 0))),
+                start=start, end=start + timedelta(minutes=1),
+                winner=players[0], loser=players[1], incomplete=True),
+            foos.Game(players=players[::-1],
+                scores=dict(zip(players, (1, 5))),
+                start=start + timedelta(minutes=4), end=self.end,
+                winner=players[1], loser=players[0]),
+            # Still being played
+            foos.Game(players=players, scores=dict(zip(players, (2, 0)))),
+            ])
+
+    def test_drift_without_games(self):
+        player = self.player('c', games=3, wins=3)
+        self.assertEqual(player.drift(), {'games': (3, 0), 'wins': (3, 0)})
+
+    def test_tally(self):
+        self.assertEqual(self.a.tally(), dict(games=2, wins=1, losses=1,
+            incomplete=1, points_for=6, points_against=8, playtime=300,
+            last_played=self.end))
+        self.assertEqual(self.b.tally(), dict(games=2, wins=1, losses=1,
+            incomplete=1, points_for=8, points_against=6, playtime=300,
+            last_played=self.end))
+
+    def test_drift(self):
+        self.assertEqual(self.a.drift()['wins'], (0, 1))
+        self.a.update(self.a.tally())
+        self.a.playtime += 0.5
+        self.assertEqual(self.a.drift(), {})
+
+    def test_repair(self):
+        count, results = foos._audit_chunk(
+                ([str(self.a._id), str(self.b._id)], True))
+        self.assertEqual(count, 2)
+        self.assertEqual(sorted(_[1] for _ in results if _[3]), ['a', 'b'])
+        for player in foos.Player.find():
+            self.assertEqual(player.drift(), {})
+
+    def test_unstarted_abort(self):
+        players = [str(self.a._id), str(self.b._id)]
+        tally = self.a.tally()
+        tournament = foos.Tournament.create('Cup', 'single', players)
+        game = foos.Game.mongo().find_one({'tournament': str(tournament._id)})
+        foos.Game.abort(str(game._id))
+        self.assertEqual(self.a.tally(), tally)
+        self.a.update(tally)
+        self.assertNotIn('incomplete', self.a.drift())
+
+    def test_command_output_is_utf8(self):
+        audit = foos.audit
+        foos.audit = lambda repair, processes: [(1, [('1', u'Jos\xe9',
+            {'wins': (0, 1)}, False)])]
+        stdout, sys.stdout = sys.stdout, io.BytesIO()
+        try:
+            self.assertEqual(foos.audit_command([]), 1)
+            output = sys.stdout.getvalue()
+        finally:
+            foos.audit, sys.stdout = audit, stdout
+        self.assertIn(u'Jos\xe9 (1)'.encode('utf-8'), output)
+
+
+if __name__ == '__main__':
+    unittest.main()